@@ -8,6 +8,8 @@ import uuid
 import time
 import argparse
 import shutil
+import re
+import multiprocessing
 
 # directory of this file
 # (e.g. /some/absolute/path/rmirro)
@@ -20,6 +22,7 @@ parser = argparse.ArgumentParser(
 parser.add_argument("name", type=str, nargs="?", default="remarkable", help="SSH hostname of reMarkable reachable with \"ssh [name]\" without password (default: remarkable)")
 parser.add_argument("-r", "--renderers", default=["render_usb.py"], nargs="+", metavar="EX", help="list of one or more executables EX in this project's directory such that \"EX infile outfile\" renders a reMarkable document with stem infile to the PDF outfile (default: render_usb.py - using the official USB web interface renderer)")
 parser.add_argument("-v", "--verbose", action="store_true", help="print executed shell commands")
+parser.add_argument("--verify", action="store_true", help="check integrity of existing PDFs on PC (structure and page count) in parallel, and pull again those that fail")
 parser.add_argument("-s", "--skip", default=["Quick sheets"], nargs="*", help="skip file names (default: skip \"Quick sheets\"; pass empty -s to include)")
 
 # TODO: --favorites-only (or by tags)
@@ -58,6 +61,7 @@ class Remarkable:
         self.raw_dir_local = os.path.abspath(f"{self.ssh_name}_metadata") # path to *.metadata files on PC (downloaded from RM) (e.g. remarkable_metadata/)
         self.backup_dir = os.path.abspath(f"{self.ssh_name}_backup") # path to save a backup of all raw RM files on PC (e.g. remarkable_backup/)
         self.last_sync_path = self.processed_dir_local + "/.last_sync" # path to a file on PC with the timestamp at which the last sync was performed
+        self.verify_cache_path = self.processed_dir_local + "/.verify_cache" # path to a file on PC with PDFs that passed --verify
 
         # create directories if they do not exist
         os.makedirs(self.processed_dir_local, exist_ok=True)
@@ -98,6 +102,19 @@ class Remarkable:
         with open(self.last_sync_path, "w") as file:
             file.write(str(t) + "\n") # s
 
+    # Read the keys of PDFs on PC that passed verification before
+    def verify_cache(self):
+        if os.path.exists(self.verify_cache_path):
+            with open(self.verify_cache_path, "r") as file:
+                return set(json.load(file))
+        return set() # never verified before
+
+    # Write the keys of PDFs on PC that passed verification
+    def write_verify_cache(self, keys):
+        with open(self.verify_cache_path, "w") as file:
+            json.dump(sorted(keys), file)
+            file.write("\n")
+
     # Generate IDs of all RM files
     def ids(self):
         for filename in os.listdir(self.raw_dir_local):
@@ -285,6 +302,16 @@ class RemarkableFile(AbstractFile):
     def last_accessed(self):
         return 0 if self.is_root else int(self.metadata()["lastOpened"]) // 1000 # s
 
+    # Returns the number of pages in this document, or None if it is unknown
+    def page_count(self):
+        content_path = rm.backup_dir + "/" + self.id + ".content" # only in the backup
+        try:
+            with open(content_path, "r") as file:
+                content = json.load(file)
+        except (OSError, ValueError): # missing or broken .content file
+            return None
+        return content.get("pageCount", None) or None # 0 means unknown, too
+
     # Download this file to its corresponding location in the PC directory
     def download(self):
         infile  = rm.backup_dir + "/" + self.id # already have raw file(s) from the backup
@@ -308,12 +335,25 @@ class RemarkableFile(AbstractFile):
             if not success:
                 panic(f"All renderers failed to render {self.path()}")
 
+            # Warn about (but keep) renders that look broken
+            npages = self.page_count()
+            verified = args.verify and verify_pdf(outfile, npages)
+            if args.verify and not verified:
+                print(f"WARNING: {self.path()} failed verification after rendering")
+                # A complete render with another page count will not improve by rendering again,
+                # so accept it until the document changes on RM (but retry incomplete renders)
+                verified = verify_pdf(outfile)
+
             # Copy last access/modification time from RM to PC file system
             # (these are used to determine sync actions)
             atime = self.last_accessed() # s
             mtime = self.last_modified() # s
             os.utime(outfile, (atime, mtime))
 
+            # Remember renders that were accepted, so they are not verified again
+            if verified:
+                verified_keys.add(verify_key(outfile, npages))
+
     # Returns the corresponding file on PC, or None if it does not exist
     def on_computer(self):
         pc_file = ComputerFile(rm.processed_dir_local).find(self.path())
@@ -437,8 +477,106 @@ class ComputerFile(AbstractFile):
         else:
             os.remove(self.path())
 
+# Check that the PDF at path is complete and has the expected number of pages (if not None)
+# (without any PDF library, so compressed page trees are only checked structurally)
+def verify_pdf(path, npages=None):
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+    except OSError:
+        return False
+
+    # Header must come first, and the trailer must end with %%EOF
+    # (truncated downloads and empty files fail here)
+    if not data.startswith(b"%PDF-"):
+        return False
+    tail = data[-1024:]
+    matches = re.findall(rb"startxref\s+(\d+)\s+%%EOF", tail)
+    if not matches:
+        return False
+
+    # The last startxref must point to a cross-reference table or stream
+    # (tolerate whitespace before it, as many writers are off by one)
+    offset = int(matches[-1])
+    if offset >= len(data):
+        return False
+    xref = data[offset:offset+64].lstrip()
+    if not (xref.startswith(b"xref") or re.match(rb"\d+\s+\d+\s+obj", xref)):
+        return False
+
+    # Follow the last trailer's /Root to the root page tree node and compare its /Count
+    # (skip this if the objects are hidden in compressed object streams)
+    if npages is not None:
+        root = re.search(rb"/Root\s+(\d+)\s+(\d+)\s+R", data[offset:])
+        catalog = root and pdf_object(data, *root.groups())
+        pages = catalog and re.search(rb"/Pages\s+(\d+)\s+(\d+)\s+R", catalog)
+        tree = pages and pdf_object(data, *pages.groups())
+        count = tree and re.search(rb"/Count\s+(\d+)", tree)
+        if count and int(count.group(1)) != npages:
+            return False
+
+    return True
+
+# Return the body of the PDF object with given number and generation, or None if it is not found
+# (the last definition wins, as incremental updates append new versions of objects)
+def pdf_object(data, num, gen):
+    bodies = re.findall(rb"(?<!\d)" + num + rb"\s+" + gen + rb"\s+obj\b(.*?)endobj", data, re.DOTALL)
+    return bodies[-1] if bodies else None
+
+# Return a key that identifies the current state of the PC file at path
+# and its expected number of pages (for caching verifications)
+def verify_key(path, npages=None):
+    stat = os.stat(path)
+    return f"{stat.st_ino}-{stat.st_size}-{stat.st_mtime_ns}-{npages}"
+
+# Wrapper around verify_pdf() that takes a single argument (for use with multiprocessing)
+def verify_pdf_job(job):
+    path, npages = job
+    return verify_pdf(path, npages)
+
+# Verify PDFs on PC in parallel for given (RM file, PC file) pairs,
+# add the keys of those that passed to verified_keys, and return the set of PC paths that failed
+# (PDFs that passed are cached by inode, size, modification time and page count, and are not checked again)
+def verify_pdfs(files):
+    cache = rm.verify_cache()
+    keys, jobs, newer_on_pc = [], [], []
+    ncached = 0
+    for rm_file, pc_file in files:
+        if rm_file.last_modified() > pc_file.last_modified():
+            continue # will be pulled anyway
+        newer = rm_file.last_modified() < pc_file.last_modified()
+        npages = None if newer else rm_file.page_count() # if edited on PC, its pages may legitimately differ from RM
+        key = verify_key(pc_file.path(), npages)
+        if key in cache:
+            verified_keys.add(key)
+            ncached += 1
+        else:
+            keys.append(key)
+            jobs.append((pc_file.path(), npages))
+            newer_on_pc.append(newer)
+
+    print(f"Verifying {len(jobs)} PDFs ({ncached} cached)")
+    results = []
+    if len(jobs) > 0:
+        with multiprocessing.Pool() as pool: # one process per core
+            results = pool.map(verify_pdf_job, jobs)
+
+    failed = set()
+    for key, (path, _), newer, success in zip(keys, jobs, newer_on_pc, results):
+        if success:
+            verified_keys.add(key)
+        else:
+            failed.add(path)
+            if newer:
+                print(f"WARNING: {path} failed verification, but is newer on PC (will not push it)")
+            elif args.verbose:
+                print(f"Failed verification of {path}")
+
+    rm.write_verify_cache(verified_keys) # forget files that no longer exist
+    return failed
+
 # Determine what to do, and why, when syncing file with given RM/PC representations
-def sync_action_and_reason(rm_file, pc_file, skip=[]):
+def sync_action_and_reason(rm_file, pc_file, skip=[], failed=set()):
     if (rm_file and rm_file.name() in skip) or (pc_file and pc_file.name() in skip):
         return "SKIP", "in --skip"
 
@@ -449,7 +587,11 @@ def sync_action_and_reason(rm_file, pc_file, skip=[]):
         if rm_file.last_modified() > pc_file.last_modified():
             return "PULL", "newer on RM"
         elif rm_file.last_modified() < pc_file.last_modified():
+            if pc_file.path() in failed:
+                return "SKIP", "newer on PC, but failed verification" # neither push a broken PDF nor overwrite edits
             return "PUSH", "newer on PC"
+        elif pc_file.path() in failed:
+            return "PULL", "failed verification"
 
     elif not rm_file and pc_file:
         # Was the file removed from RM or created on PC after last sync?
@@ -499,9 +641,17 @@ if __name__ == "__main__":
     print("Will use renderer(s)", " -> ".join(renderers))
 
     print("Comparing files and collecting commands")
+    files = list(iterate_files())
+
+    # Find PDFs on PC that are broken, so they can be pulled again
+    failed = set()
+    verified_keys = set() # PDFs on PC that passed verification
+    if args.verify:
+        failed = verify_pdfs([(rm_file, pc_file) for rm_file, pc_file in files if rm_file and pc_file and rm_file.is_file() and rm_file.name() not in skip and pc_file.name() not in skip])
+
     commands = {"PULL": [], "PUSH": [], "DROP": []}
-    for rm_file, pc_file in iterate_files():
-        action, reason = sync_action_and_reason(rm_file, pc_file, skip=skip)
+    for rm_file, pc_file in files:
+        action, reason = sync_action_and_reason(rm_file, pc_file, skip=skip, failed=failed)
         path = rm_file.path() if rm_file else pc_file.path_on_remarkable()
         if action != "SKIP":
             commands[action].append((action, reason, path, rm_file, pc_file))
@@ -546,6 +696,8 @@ if __name__ == "__main__":
             pc_file.remove()
 
     rm.write_last_sync()
+    if args.verify:
+        rm.write_verify_cache(verified_keys) # include PDFs that were rendered and verified now
 
     # RM interface must be restarted to show newly added files
     if npush > 0: